@@ -1,8 +1,68 @@
+import atexit
+from collections.abc import Callable
 import os
+from threading import Lock
+from typing import Any
 
-from not_again_ai.llm.chat_completion.providers.ollama_api import ollama_client
-from not_again_ai.llm.chat_completion.providers.openai_api import openai_client
+from azure.identity import DefaultAzureCredential, get_bearer_token_provider
+from ollama import Client
+from openai import AzureOpenAI, OpenAI
 
-OLLAMA_CLIENT = ollama_client()
-OPENAI_CLIENT = openai_client(api_type="openai", api_key=os.getenv("OPENAI_API_KEY"))
-AZURE_OPENAI_CLIENT = openai_client(api_type="azure_openai", api_key=os.getenv("AZURE_OPENAI_PAI_KEY"))
+AZURE_OPENAI_API_VERSION = "2024-06-01"
+
+
+def _ollama_client() -> Callable[..., Any]:
+    """Ollama client callable for chat_completion. Reads the host from OLLAMA_HOST, defaulting to localhost."""
+    client = Client()
+    atexit.register(client.close)
+
+    def client_callable(**kwargs: Any) -> Any:
+        return client.chat(**kwargs)
+
+    return client_callable
+
+
+def _openai_client(client: OpenAI) -> Callable[..., Any]:
+    """OpenAI or Azure OpenAI client callable for chat_completion.
+    Unlike not_again_ai's openai_client, which constructs a new SDK client for every request,
+    this reuses a single client so its connection pool is shared by every request and thread.
+    """
+    atexit.register(client.close)
+
+    def client_callable(**kwargs: Any) -> Any:
+        return client.chat.completions.create(**kwargs).to_dict()
+
+    return client_callable
+
+
+def _azure_openai_client() -> Callable[..., Any]:
+    # Prefer the API key if set, otherwise authenticate with the signed in Azure identity
+    api_key = os.getenv("AZURE_OPENAI_PAI_KEY")
+    if api_key:
+        client = AzureOpenAI(api_version=AZURE_OPENAI_API_VERSION, api_key=api_key)
+    else:
+        token_provider = get_bearer_token_provider(
+            DefaultAzureCredential(), "https://cognitiveservices.azure.com/.default"
+        )
+        client = AzureOpenAI(api_version=AZURE_OPENAI_API_VERSION, azure_ad_token_provider=token_provider)
+    return _openai_client(client)
+
+
+# Each client is created on first access (see __getattr__) so that importing the package does not set up every provider.
+_CLIENT_FACTORIES = {
+    "OLLAMA_CLIENT": _ollama_client,
+    "OPENAI_CLIENT": lambda: _openai_client(OpenAI(api_key=os.getenv("OPENAI_API_KEY"))),
+    "AZURE_OPENAI_CLIENT": _azure_openai_client,
+}
+_CLIENT_LOCK = Lock()
+
+
+def __getattr__(name: str) -> Any:
+    if name not in _CLIENT_FACTORIES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    with _CLIENT_LOCK:
+        # Another thread may have created the client while waiting for the lock
+        if name not in globals():
+            globals()[name] = _CLIENT_FACTORIES[name]()
+    return globals()[name]
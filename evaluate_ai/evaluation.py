@@ -1,20 +1,40 @@
 """Defines abstractions for implementing custom evaluations."""
 
 from abc import ABC, abstractmethod
+from collections.abc import Callable, Hashable, Iterator
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from datetime import UTC, datetime
+from functools import cache
 import importlib
 from pathlib import Path
-from typing import Literal
+from queue import Queue
+import sys
+from threading import Lock, Thread
+from typing import Any, Literal, TypeVar
 
 from loguru import logger
-import pendulum
-from pydantic import BaseModel, Field, ValidationError
-from pydantic_extra_types.pendulum_dt import DateTime
+from not_again_ai.llm.chat_completion import chat_completion
+from not_again_ai.llm.chat_completion.types import ChatCompletionRequest, ChatCompletionResponse
+from pydantic import BaseModel, Field, PositiveInt, ValidationError
 from rich.progress import Progress
-from tinydb import TinyDB
-import yaml
 
-from evaluate_ai.tinydb_helpers.db_path import TINYDB_PATH
-from evaluate_ai.utils import Provider
+from evaluate_ai.tinydb_helpers.database import DB_LOCK, get_db
+from evaluate_ai.tinydb_helpers.response_cache import get_response_cache
+from evaluate_ai.utils import Provider, get_llm_client, get_rate_limiter, load_yaml
+
+T = TypeVar("T")
+
+# The number of evaluation outputs buffered before they are written to the database together.
+SAVE_BATCH_SIZE = 100
+
+
+@cache
+def _resolve_class(module_name: str, class_name: str) -> type:
+    """Import the evaluation module and return the class with the given name.
+    Cached since the same few classes are resolved for every document loaded from the database.
+    """
+    module = importlib.import_module(f"evaluate_ai.evaluations.{module_name}")
+    return getattr(module, class_name)
 
 
 class EvaluationRunConfig(BaseModel):
@@ -29,6 +49,34 @@ class EvaluationRunConfig(BaseModel):
     # Defines the models that each evaluation will be run on.
     # It is up to the evaluation to determine how to use this information.
     models: dict[Provider, list[str]] | None
+    max_concurrency: int = Field(
+        default=4,
+        ge=1,
+        description="The maximum number of evaluation instances executed concurrently for each provider.",
+    )
+    provider_concurrency: dict[Provider, PositiveInt] = Field(
+        default_factory=dict,
+        description="Overrides max_concurrency for specific providers, such as a lower limit for a local Ollama server.",
+    )
+    requests_per_minute: dict[Provider, PositiveInt] = Field(
+        default_factory=dict,
+        description="Limits the rate of LLM requests sent to specific providers, to stay under their rate limits.",
+    )
+    cache_responses: bool = Field(
+        default=False,
+        description="If set, responses are cached on disk and reused when an identical request is sent again, such as in a re-run. "
+        "Requests with a nonzero temperature are only cached by evaluations that opt in, currently MMLU-Pro and structured output, "
+        "unless cache_sampled_responses is also set.",
+    )
+    cache_sampled_responses: bool = Field(
+        default=False,
+        description="If set with cache_responses, requests with a nonzero temperature are cached in every evaluation, "
+        "reusing one sample instead of drawing a new one.",
+    )
+
+    def concurrency_for(self, provider: Provider) -> int:
+        """Returns the maximum number of concurrent evaluation instances for the provider."""
+        return self.provider_concurrency.get(provider, self.max_concurrency)
 
 
 class EvaluationInstance(BaseModel):
@@ -53,7 +101,7 @@ class EvaluationConfig(BaseModel):
     evaluation_instances: list[EvaluationInstance]
 
     @classmethod
-    def load(cls, path: Path) -> "EvaluationRunConfig":
+    def load(cls, path: Path) -> "EvaluationConfig":
         """Class method to load, validate, and handle errors for the configuration from a YAML file.
 
         Args:
@@ -66,12 +114,13 @@ class EvaluationConfig(BaseModel):
             Logs error messages instead of raising exceptions to allow execution to continue.
         """
         try:
-            with path.open() as file:
-                data = yaml.safe_load(file)
-                config_data = {}
-                config_data["run_config"] = data.get("run_config", {})
-                config_data["evaluation_instances"] = data.get("evaluation_instances", [])
-            return cls(**config_data)
+            data = load_yaml(path)
+            return cls.model_validate(
+                {
+                    "run_config": data.get("run_config", {}),
+                    "evaluation_instances": data.get("evaluation_instances", []),
+                }
+            )
         except FileNotFoundError:
             logger.error(f"The file {path} does not exist.")
         except ValidationError as e:
@@ -90,16 +139,26 @@ class EvaluationBaseOutput(BaseModel):
     name_model: str = Field(None, description="Name of the mode being evaluated.")
     provider: Provider = Field(None, description="The provider of the model, such as OpenAI or Ollama.")
     score: float = Field(None, description="The score out of 100 for this evaluation instance.")
-    execution_date: DateTime = Field(
-        default_factory=pendulum.now, description="The datetime the evaluation instance was executed."
+    execution_date: datetime = Field(
+        default_factory=lambda: datetime.now(UTC), description="The datetime the evaluation instance was executed."
     )
 
     def save_to_db(self) -> None:
         """Insert the current state of EvaluationData into a TinyDB database."""
-        db = TinyDB(TINYDB_PATH)
+        self.save_many_to_db([self])
 
-        evaluation_data_dict = self.to_dict(self)
-        db.insert(evaluation_data_dict)
+    @staticmethod
+    def save_many_to_db(outputs: list["EvaluationBaseOutput"]) -> None:
+        """Insert multiple outputs into the TinyDB database with a single write.
+        TinyDB rewrites the whole database file on every insert, so batching avoids rewriting it once per output.
+        """
+        if not outputs:
+            return
+        documents = [output.to_dict(output) for output in outputs]
+        with DB_LOCK:
+            db = get_db()
+            db.insert_multiple(documents)
+            db.storage.flush()
 
     @staticmethod
     def to_dict(instance: BaseModel) -> dict:
@@ -110,9 +169,8 @@ class EvaluationBaseOutput(BaseModel):
     @staticmethod
     def load_class(module_name: str, class_name: str, data: dict) -> "EvaluationBaseOutput":
         """Load the class dynamically from the module and class name."""
-        module = importlib.import_module(f"evaluate_ai.evaluations.{module_name}")
-        class_ = getattr(module, class_name)
-        evaluation_output_class: EvaluationBaseOutput = class_(**data)
+        class_ = _resolve_class(module_name, class_name)
+        evaluation_output_class: EvaluationBaseOutput = class_.model_validate(data)
         return evaluation_output_class
 
 
@@ -134,53 +192,221 @@ class EvaluationOverallOutput(EvaluationBaseOutput):
     evaluation_instances: list[EvaluationInstanceOutput] = Field(description="The list of evaluation instances.")
 
 
+class _DBWriter:
+    """Saves evaluation outputs to the database from a background thread in batches of SAVE_BATCH_SIZE,
+    so that writing to the database does not hold up collecting results.
+    """
+
+    def __init__(self) -> None:
+        self._queue: Queue[EvaluationBaseOutput | None] = Queue()
+        self._error: BaseException | None = None
+        self._thread = Thread(target=self._run, name="evaluation-db-writer", daemon=True)
+        self._thread.start()
+
+    def enqueue(self, output: EvaluationBaseOutput) -> None:
+        self._queue.put(output)
+
+    def close(self) -> None:
+        """Save any outputs still queued, stop the writer thread, and raise any error it encountered."""
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def _run(self) -> None:
+        batch: list[EvaluationBaseOutput] = []
+        try:
+            while (output := self._queue.get()) is not None:
+                batch.append(output)
+                if len(batch) >= SAVE_BATCH_SIZE:
+                    EvaluationBaseOutput.save_many_to_db(batch)
+                    batch = []
+            EvaluationBaseOutput.save_many_to_db(batch)
+        except BaseException as e:
+            self._error = e
+
+
 class Evaluation(ABC):
     @abstractmethod
     def __init__(self, config: EvaluationConfig) -> None:
         self.config = config
-        # Get a tuple of (provider, model) for each model in the run config
+        # Get a tuple of (provider, model) for each model in the run config.
+        # Model names are interned so skip key lookups can match the interned names in executed keys by identity.
         self.models: list[tuple[Provider, str]] = []
         for provider, models in self.config.run_config.models.items():
             for model in models:
-                self.models.append((provider, model))
+                self.models.append((provider, sys.intern(model)))
+        # Responses shared by instances that send an identical request, see _coalesce
+        self._responses: dict[Hashable, Future] = {}
+        self._responses_lock = Lock()
+        self._plan: tuple[frozenset, list[tuple[Provider, str, EvaluationInstance]]] | None = None
+        self._rate_limiters = {
+            provider: get_rate_limiter(provider, rpm)
+            for provider, rpm in self.config.run_config.requests_per_minute.items()
+        }
+        self._response_cache = get_response_cache() if self.config.run_config.cache_responses else None
 
     @abstractmethod
     def _get_output_class(self) -> type[EvaluationInstanceOutput]:
         """Return the EvaluationInstanceOutput class used by this evaluation."""
 
-    def num_instances(self, keys_to_skip: set) -> int:
+    def num_instances(self, keys_to_skip: frozenset[tuple[str, str, str, str]]) -> int:
         """Calculate number of evaluation instances to run.
 
         Args:
-            keys_to_skip: Set of already executed evaluation keys to skip
+            keys_to_skip: Frozenset of already executed evaluation keys to skip
 
         Returns:
             Number of evaluation instances that will be executed
         """
-        num = 0
+        if not keys_to_skip:
+            return len(self.models) * len(self.config.evaluation_instances)
+
+        return len(self._build_plan(keys_to_skip))
+
+    def _build_plan(
+        self, keys_to_skip: frozenset[tuple[str, str, str, str]]
+    ) -> list[tuple[Provider, str, EvaluationInstance]]:
+        """Returns the (provider, model, evaluation instance) combinations that have not been executed yet.
+
+        Args:
+            keys_to_skip (frozenset[tuple[str, str, str, str]]): A frozenset of unique keys of instances to skip.
+        """
+        # num_instances and execute are called with the same keys in a run, so the last plan is reused
+        if self._plan is not None and self._plan[0] is keys_to_skip:
+            return self._plan[1]
+
+        class_name = self._get_output_class().__name__
+        plan = []
         for provider, model in self.models:
+            provider_value = provider.value
             for e_instance in self.config.evaluation_instances:
-                key = (self._get_output_class().__name__, model, provider.value, e_instance.name)
-                if key not in keys_to_skip:
-                    num += 1
-        return num
+                if (class_name, model, provider_value, e_instance.name) not in keys_to_skip:
+                    plan.append((provider, model, e_instance))
+        self._plan = (keys_to_skip, plan)
+        return plan
 
     @abstractmethod
-    def execute(self, progress: Progress, keys_to_skip: tuple) -> None:
+    def _run_instance(self, provider: Provider, model: str, e_instance: EvaluationInstance) -> EvaluationInstanceOutput:
+        """Execute a single evaluation instance against a model and return its output.
+        NOTE: This is called concurrently from worker threads, so it should not mutate shared state.
+        The output can be built with `model_construct` since all of its inputs are already validated.
+
+        Args:
+            provider (Provider): The provider of the model.
+            model (str): The name of the model to evaluate.
+            e_instance (EvaluationInstance): The evaluation instance to execute.
+        """
+
+    def _get_client(self, provider: Provider) -> Any:
+        """Return the LLM client for the provider, limited to the configured requests per minute if any."""
+        llm_client = get_llm_client(provider)
+        rate_limiter = self._rate_limiters.get(provider)
+        return llm_client if rate_limiter is None else rate_limiter.limit(llm_client)
+
+    def _chat_completion(
+        self, request: ChatCompletionRequest, provider: Provider, cache_sampled: bool = False
+    ) -> ChatCompletionResponse:
+        """Send the request, reusing the cached response to an identical request when response caching is enabled.
+
+        Args:
+            request (ChatCompletionRequest): The request to send.
+            provider (Provider): The provider to send the request to.
+            cache_sampled (bool): Cache the response even if the request has a nonzero temperature,
+                for evaluations where reusing one sample across re-runs is acceptable.
+        """
+        run_config = self.config.run_config
+        cacheable = request.temperature == 0 or cache_sampled or run_config.cache_sampled_responses
+        if self._response_cache is None or not cacheable:
+            return chat_completion(request, provider=provider.chat_completion_name, client=self._get_client(provider))
+
+        key = self._response_cache.make_key(provider.value, request)
+        response = self._response_cache.get(key)
+        if response is None:
+            response = chat_completion(
+                request, provider=provider.chat_completion_name, client=self._get_client(provider)
+            )
+            self._response_cache.put(key, response)
+        return response
+
+    def _coalesce(self, key: Hashable, get_response: Callable[[], T]) -> T:
+        """Return the response for the request identified by key, calling get_response only for the first request.
+        Instances that send an identical request, including ones running concurrently in other threads,
+        share that response instead of issuing another LLM call. A failed request is not cached.
+
+        Args:
+            key (Hashable): Uniquely identifies the request, such as (provider, model, prompt).
+            get_response (Callable[[], T]): Makes the request.
+        """
+        with self._responses_lock:
+            future = self._responses.get(key)
+            is_owner = future is None
+            if is_owner:
+                future = self._responses[key] = Future()
+
+        if is_owner:
+            try:
+                future.set_result(get_response())
+            except BaseException as e:
+                future.set_exception(e)
+                with self._responses_lock:
+                    del self._responses[key]
+        return future.result()
+
+    def execute(self, progress: Progress, keys_to_skip: frozenset[tuple[str, str, str, str]]) -> None:
         """Execute the evaluation. Takes in a rich progress bar to update progress.
-        NOTE: This should call progress.advance(0) each time one of the num_instances
-        evaluation instances is completed
+        Evaluation instances are dispatched to a thread pool per provider since each one is bound by LLM requests.
+        Each provider only has as many instances in flight as its concurrency limit.
+        Progress is advanced from the calling thread as each instance completes,
+        and outputs are saved to the database in batches of SAVE_BATCH_SIZE by a background writer thread.
 
         Args:
             progress (Progress): The rich progress bar to update.
-            keys_to_skip (tuple): A set of unique keys to skip when counting the number of instances.
+            keys_to_skip (frozenset[tuple[str, str, str, str]]): A frozenset of unique keys of instances to skip.
                 Each key consists of: (EvaluationInstanceOutput class name, model, provider, evaluation_instance_name).
         """
+        work: dict[Provider, list[tuple[Provider, str, EvaluationInstance]]] = {}
+        for item in self._build_plan(keys_to_skip):
+            work.setdefault(item[0], []).append(item)
+
+        # Separate pools per provider so that each provider's concurrency is bounded independently
+        remaining: dict[Provider, Iterator[tuple[Provider, str, EvaluationInstance]]] = {
+            provider: iter(items) for provider, items in work.items()
+        }
+        executors = {
+            provider: ThreadPoolExecutor(max_workers=self.config.run_config.concurrency_for(provider))
+            for provider in remaining
+        }
+        # Only as many instances as a provider has workers are submitted at a time,
+        # so large evaluations do not queue a future for every instance up front.
+        in_flight: dict[Future[EvaluationInstanceOutput], Provider] = {}
+
+        def submit_next(provider: Provider) -> None:
+            item = next(remaining[provider], None)
+            if item is not None:
+                in_flight[executors[provider].submit(self._run_instance, *item)] = provider
+
+        db_writer = _DBWriter()
+        try:
+            for provider in remaining:
+                for _ in range(self.config.run_config.concurrency_for(provider)):
+                    submit_next(provider)
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    provider = in_flight.pop(future)
+                    db_writer.enqueue(future.result())
+                    progress.advance(0)
+                    submit_next(provider)
+        finally:
+            for executor in executors.values():
+                executor.shutdown(cancel_futures=True)
+            # Save whatever completed, even if another instance failed
+            db_writer.close()
 
     @staticmethod
     def load_class(module_name: str, class_name: str, config: EvaluationConfig) -> "Evaluation":
         """Load the class dynamically from the module and class name."""
-        module = importlib.import_module(f"evaluate_ai.evaluations.{module_name}")
-        class_ = getattr(module, class_name)
+        class_ = _resolve_class(module_name, class_name)
         evaluation_class: Evaluation = class_(config=config)
         return evaluation_class
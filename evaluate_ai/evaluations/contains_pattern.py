@@ -1,30 +1,33 @@
+from datetime import date
 import re
+from typing import Any
 
-from not_again_ai.llm.chat_completion import chat_completion
 from not_again_ai.llm.chat_completion.types import (
     ChatCompletionRequest,
     ChatCompletionResponse,
+    MessageT,
     SystemMessage,
     UserMessage,
 )
-from not_again_ai.llm.prompting.compile_messages import compile_messages
-import pendulum
-from pydantic import Field
-from rich.progress import Progress
+from pydantic import Field, PrivateAttr
 
 from evaluate_ai.evaluation import Evaluation, EvaluationConfig, EvaluationInstance, EvaluationInstanceOutput
-from evaluate_ai.utils import get_llm_client
+from evaluate_ai.utils import Provider, parse_messages, render_messages
+
+# The date is kept on the last line so the rest of the prompt is a stable prefix for provider prompt caching
+DEFAULT_SYSTEM_PROMPT = """- You are a helpful assistant.
+- You should answer questions truthfully and accurately.
+- The current date is {date}."""
 
 CONTAINS_PATTERN_MESSAGES = [
     SystemMessage(
-        content="""{% if system_prompt %}{{ system_prompt }}{% else %}- You are a helpful assistant.
-- The current date is {{datetime}}.
-- You should answer questions truthfully and accurately.{% endif %}""",
+        content="""{{system_prompt}}""",
     ),
     UserMessage(
         content="""{{prompt}}""",
     ),
 ]
+CONTAINS_PATTERN_MESSAGES_TEMPLATES = parse_messages(CONTAINS_PATTERN_MESSAGES)
 
 
 class EvaluationInstanceContainsPattern(EvaluationInstance):
@@ -38,6 +41,15 @@ class EvaluationInstanceContainsPattern(EvaluationInstance):
     pattern: str = Field(
         description="The regex pattern to check for in the model output.",
     )
+    _compiled_pattern: re.Pattern = PrivateAttr()
+
+    def model_post_init(self, __context: Any) -> None:
+        # Compile once at load time since the pattern is reused for every model
+        self._compiled_pattern = re.compile(self.pattern)
+
+    @property
+    def compiled_pattern(self) -> re.Pattern:
+        return self._compiled_pattern
 
 
 class EvaluationConfigContainsPattern(EvaluationConfig):
@@ -56,59 +68,60 @@ class EvaluationInstanceOutputContainsPattern(EvaluationInstanceOutput):
 
 class EvaluationContainsPattern(Evaluation):
     def __init__(self, config: EvaluationConfigContainsPattern) -> None:
-        self.config: EvaluationConfigContainsPattern = EvaluationConfigContainsPattern(**config)
+        self.config: EvaluationConfigContainsPattern = EvaluationConfigContainsPattern.model_validate(config)
         super().__init__(self.config)
+        # Render the default system prompt once so every instance in the run shares it, even if it crosses midnight
+        self._default_system_prompt = DEFAULT_SYSTEM_PROMPT.format(date=date.today().isoformat())
+        # Render the messages for each distinct pair of prompts once, since they are sent to every model
+        self._messages: dict[tuple[str | None, str], list[MessageT]] = {}
+        for e_instance in self.config.evaluation_instances:
+            key = (e_instance.system_prompt, e_instance.prompt)
+            if key not in self._messages:
+                self._messages[key] = render_messages(
+                    CONTAINS_PATTERN_MESSAGES_TEMPLATES,
+                    variables={
+                        "system_prompt": e_instance.system_prompt or self._default_system_prompt,
+                        "prompt": e_instance.prompt,
+                    },
+                )
 
     def _get_output_class(self) -> type[EvaluationInstanceOutput]:
         return EvaluationInstanceOutputContainsPattern
 
-    def execute(self, progress: Progress, keys_to_skip: set) -> None:
-        for provider, model in self.models:
-            for e_instance in self.config.evaluation_instances:
-                key = (EvaluationInstanceOutputContainsPattern.__name__, model, provider.value, e_instance.name)
-                if key not in keys_to_skip:
-                    response = self._get_response(
-                        system_prompt=e_instance.system_prompt,
-                        prompt=e_instance.prompt,
-                        model=model,
-                        provider=provider.value,
-                    )
-                    message = response.choices[0].message.content
-                    score = self._evaluate(message, e_instance.pattern)
-                    instance_output = EvaluationInstanceOutputContainsPattern(
-                        module_name=self.config.run_config.module_name,
-                        class_name=EvaluationInstanceOutputContainsPattern.__name__,
-                        name_model=model,
-                        provider=provider,
-                        evaluation_instance=e_instance,
-                        message=message,
-                        score=score,
-                        prompt_tokens_total=response.prompt_tokens,
-                        completion_tokens_total=response.completion_tokens,
-                        duration_sec_total=response.response_duration,
-                    )
-                    instance_output.save_to_db()
-                    progress.advance(0)
-
-    def _get_response(self, system_prompt: str, prompt: str, model: str, provider: str) -> ChatCompletionResponse:
-        messages = compile_messages(
-            messages=CONTAINS_PATTERN_MESSAGES,
-            variables={
-                "system_prompt": system_prompt,
-                "prompt": prompt,
-                "datetime": pendulum.now().strftime("%Y-%m-%d"),
-            },
+    def _run_instance(
+        self, provider: Provider, model: str, e_instance: EvaluationInstanceContainsPattern
+    ) -> EvaluationInstanceOutputContainsPattern:
+        # Instances with the same prompts share one response per model
+        prompts = (e_instance.system_prompt, e_instance.prompt)
+        response = self._coalesce(
+            (provider, model, *prompts),
+            lambda: self._get_response(messages=self._messages[prompts], model=model, provider=provider),
         )
+        message = response.choices[0].message.content
+        score = self._evaluate(message, e_instance.compiled_pattern)
+        return EvaluationInstanceOutputContainsPattern.model_construct(
+            module_name=self.config.run_config.module_name,
+            class_name=EvaluationInstanceOutputContainsPattern.__name__,
+            name_model=model,
+            provider=provider,
+            evaluation_instance=e_instance,
+            message=message,
+            score=score,
+            prompt_tokens_total=response.prompt_tokens,
+            completion_tokens_total=response.completion_tokens,
+            duration_sec_total=response.response_duration,
+        )
+
+    def _get_response(self, messages: list[MessageT], model: str, provider: Provider) -> ChatCompletionResponse:
         request = ChatCompletionRequest(
             messages=messages,
             model=model,
             temperature=0.7,
         )
-        response = chat_completion(request, provider=provider, client=get_llm_client(provider))
+        response = self._chat_completion(request, provider)
         return response
 
-    def _evaluate(self, response: str, pattern: str) -> float:
-        pattern = re.compile(pattern)
-        success = bool(pattern.search(response))
+    def _evaluate(self, response: str, pattern: re.Pattern) -> float:
+        success = pattern.search(response) is not None
         score = 100 if success else 0
         return score
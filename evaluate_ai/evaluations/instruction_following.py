@@ -1,9 +1,11 @@
 """Based on https://github.com/google-research/google-research/blob/master/instruction_following_eval/"""
 
-from not_again_ai.llm.chat_completion import chat_completion
+import heapq
+from itertools import chain
+from typing import Any
+
 from not_again_ai.llm.chat_completion.types import ChatCompletionRequest, ChatCompletionResponse, UserMessage
-from pydantic import Field
-from rich.progress import Progress
+from pydantic import Field, PrivateAttr, field_validator
 
 from evaluate_ai.evaluation import (
     Evaluation,
@@ -13,7 +15,8 @@ from evaluate_ai.evaluation import (
     EvaluationRunConfig,
 )
 from evaluate_ai.evaluations.instruction_following_eval import instructions_registry
-from evaluate_ai.utils import download_jsonl, get_llm_client
+from evaluate_ai.evaluations.instruction_following_eval.instructions import Instruction
+from evaluate_ai.utils import Provider, iter_jsonl
 
 
 class EvaluationInstanceIFEval(EvaluationInstance):
@@ -22,6 +25,41 @@ class EvaluationInstanceIFEval(EvaluationInstance):
     prompt: str
     instruction_id_list: list[str]
     kwargs: list[dict[str, str | int | None | list[str]]]
+    _instructions: list[Instruction] = PrivateAttr(default_factory=list)
+    _messages: list[UserMessage] = PrivateAttr()
+
+    def model_post_init(self, __context: Any) -> None:
+        # The same messages are sent to every model
+        self._messages = [UserMessage(content=self.prompt)]
+
+    @property
+    def messages(self) -> list[UserMessage]:
+        return self._messages
+
+    @property
+    def instructions(self) -> list[Instruction]:
+        """The instruction checkers built by `build_instructions`."""
+        return self._instructions
+
+    def build_instructions(self) -> None:
+        """Instantiates the checker for each instruction so it can be reused for every model's response."""
+        self._instructions = []
+        for instruction_id, instruction_kwargs in zip(self.instruction_id_list, self.kwargs, strict=True):
+            instruction = instructions_registry.INSTRUCTION_DICT[instruction_id](instruction_id)
+            instruction.build_description(**instruction_kwargs)
+            args = instruction.get_instruction_args()
+            if args and "prompt" in args:
+                instruction.build_description(prompt="")
+            self._instructions.append(instruction)
+
+    @field_validator("kwargs")
+    @classmethod
+    def rename_section_spliter(cls, kwargs: list[dict[str, Any]]) -> list[dict[str, Any]]:
+        """The dataset misspells the "section_splitter" argument as "section_spliter", so it is renamed at load time."""
+        for instruction_kwargs in kwargs:
+            if "section_spliter" in instruction_kwargs:
+                instruction_kwargs["section_splitter"] = instruction_kwargs.pop("section_spliter")
+        return kwargs
 
 
 class EvaluationRunConfigIFEval(EvaluationRunConfig):
@@ -56,105 +94,77 @@ class EvaluationInstanceOutputIFEval(EvaluationInstanceOutput):
 
 class IFEvalEvaluation(Evaluation):
     def __init__(self, config: EvaluationConfigIFEval) -> None:
-        self.config: EvaluationConfigIFEval = EvaluationConfigIFEval(**config)
+        self.config: EvaluationConfigIFEval = EvaluationConfigIFEval.model_validate(config)
         super().__init__(self.config)
 
         # Extract the file name from the URL
         file_name = self.config.run_config.data_url.split("/")[-1]
-        self.data = download_jsonl(self.config.run_config.data_url, file_name)
-        # Create the evaluation instances from the downloaded data
-        for row in self.data:
-            instance_data = {
-                "name": str(row["key"]),
-                "prompt": row["prompt"],
-                "instruction_id_list": row["instruction_id_list"],
-                "kwargs": row["kwargs"],
-            }
-            self.config.evaluation_instances.append(EvaluationInstanceIFEval(**instance_data))
+        # Create the evaluation instances while streaming the downloaded data
+        instances = chain(
+            self.config.evaluation_instances,
+            (
+                EvaluationInstanceIFEval(
+                    name=str(row["key"]),
+                    prompt=row["prompt"],
+                    instruction_id_list=row["instruction_id_list"],
+                    kwargs=row["kwargs"],
+                )
+                for row in iter_jsonl(self.config.run_config.data_url, file_name)
+            ),
+        )
 
         # Sort the instances by name and take the first n instances if provided
-        self.config.evaluation_instances.sort(key=lambda x: x.name)
         if self.config.run_config.first_n_instances:
-            self.config.evaluation_instances = self.config.evaluation_instances[
-                : self.config.run_config.first_n_instances
-            ]
+            self.config.evaluation_instances = heapq.nsmallest(
+                self.config.run_config.first_n_instances, instances, key=lambda x: x.name
+            )
+        else:
+            self.config.evaluation_instances = sorted(instances, key=lambda x: x.name)
+        for e_instance in self.config.evaluation_instances:
+            e_instance.build_instructions()
 
     def _get_output_class(self) -> type[EvaluationInstanceOutput]:
         return EvaluationInstanceOutputIFEval
 
-    def execute(self, progress: Progress, keys_to_skip: set) -> None:
-        """Execute the evaluation for each model and instance."""
-        for provider, model in self.models:
-            for e_instance in self.config.evaluation_instances:
-                key = (EvaluationInstanceOutputIFEval.__name__, model, provider.value, e_instance.name)
-                if key not in keys_to_skip:
-                    response = self._get_response(
-                        e_instance.prompt,
-                        model,
-                        provider.value,
-                    )
-
-                    score = self._evaluate(
-                        response.choices[0].message.content,
-                        e_instance.instruction_id_list,
-                        e_instance.kwargs,
-                    )
-
-                    instance_output = EvaluationInstanceOutputIFEval(
-                        module_name=self.config.run_config.module_name,
-                        class_name=EvaluationInstanceOutputIFEval.__name__,
-                        name_model=model,
-                        provider=provider.value,
-                        evaluation_instance=e_instance,
-                        message=response.choices[0].message.content,
-                        score=score,
-                        prompt_tokens_total=response.prompt_tokens,
-                        completion_tokens_total=response.completion_tokens,
-                        duration_sec_total=response.response_duration,
-                    )
-                    instance_output.save_to_db()
-                    progress.advance(0)
-
-    def _get_response(self, prompt: str, model: str, provider: str) -> ChatCompletionResponse:
-        messages = [
-            UserMessage(
-                content=f"{prompt}",
-            ),
-        ]
+    def _run_instance(
+        self, provider: Provider, model: str, e_instance: EvaluationInstanceIFEval
+    ) -> EvaluationInstanceOutputIFEval:
+        """Execute the evaluation instance against the model."""
+        response = self._get_response(e_instance.messages, model, provider)
+
+        score = self._evaluate(response.choices[0].message.content, e_instance.instructions)
+
+        return EvaluationInstanceOutputIFEval.model_construct(
+            module_name=self.config.run_config.module_name,
+            class_name=EvaluationInstanceOutputIFEval.__name__,
+            name_model=model,
+            provider=provider,
+            evaluation_instance=e_instance,
+            message=response.choices[0].message.content,
+            score=score,
+            prompt_tokens_total=response.prompt_tokens,
+            completion_tokens_total=response.completion_tokens,
+            duration_sec_total=response.response_duration,
+        )
+
+    def _get_response(self, messages: list[UserMessage], model: str, provider: Provider) -> ChatCompletionResponse:
         request = ChatCompletionRequest(
             messages=messages,
             model=model,
             temperature=0.5,
             max_completion_tokens=2000,
         )
-        response = chat_completion(request, provider=provider, client=get_llm_client(provider))
+        response = self._chat_completion(request, provider)
         return response
 
-    def _evaluate(
-        self,
-        response: str,
-        instruction_id_list: list[str],
-        kwargs: list[dict[str, str | int | None | list[str]]],
-    ) -> float:
+    def _evaluate(self, response: str, instructions: list[Instruction]) -> float:
         """Tests response to see if instructions are followed."""
-        is_following_list = []
-        for index, instruction_id in enumerate(instruction_id_list):
-            instruction_cls = instructions_registry.INSTRUCTION_DICT[instruction_id]
-            instruction = instruction_cls(instruction_id)
-            # if kwargs contains a key "section_spliter", rename it to "section_splitter"
-            if "section_spliter" in kwargs[index]:
-                kwargs[index]["section_splitter"] = kwargs[index]["section_spliter"]
-                del kwargs[index]["section_spliter"]
-            instruction.build_description(**kwargs[index])
-            args = instruction.get_instruction_args()
-            if args and "prompt" in args:
-                instruction.build_description(prompt="")
+        # An empty response cannot follow any instruction
+        if not response.strip():
+            return 0
 
-            if response.strip() and instruction.check_following(response):
-                is_following_list.append(True)
-            else:
-                is_following_list.append(False)
+        num_followed = sum(1 for instruction in instructions if instruction.check_following(response))
 
         # Compute the score based on the number of instructions that are followed
-        score = (sum(is_following_list) / len(is_following_list)) * 100
+        score = (num_followed / len(instructions)) * 100
         return score
@@ -382,7 +382,7 @@ class ConstrainedStartChecker(Instruction):
         """
         response_pattern = r"^\s*" + self._starter + r".*$"
         response_with_constrained_start = re.search(response_pattern, value, flags=re.MULTILINE)
-        return bool(response_with_constrained_start)
+        return response_with_constrained_start is not None
 
 
 class HighlightSectionChecker(Instruction):
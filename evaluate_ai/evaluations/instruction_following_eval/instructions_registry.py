@@ -1,5 +1,7 @@
 """Registry of all instructions."""
 
+import collections
+
 from evaluate_ai.evaluations.instruction_following_eval import instructions
 
 _KEYWORD = "keywords:"
@@ -120,8 +122,12 @@ def conflict_make(conflicts):
       Revised version of the dictionary. All instructions conflict with
       themselves. If A conflicts with B, B will conflict with A.
     """
-    for key in conflicts:
-        for k in conflicts[key]:
-            conflicts[k].add(key)
+    # Build the reverse edges in one pass instead of adding them while iterating over the dictionary
+    reverse_conflicts = collections.defaultdict(set)
+    for key, conflicting_ids in conflicts.items():
+        for k in conflicting_ids:
+            reverse_conflicts[k].add(key)
+    for key in conflicts.keys() | reverse_conflicts.keys():
+        conflicts.setdefault(key, set()).update(reverse_conflicts[key])
         conflicts[key].add(key)
     return conflicts
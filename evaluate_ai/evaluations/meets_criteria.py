@@ -1,11 +1,14 @@
-from not_again_ai.llm.chat_completion import chat_completion
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import blake2b
+import re
+
 from not_again_ai.llm.chat_completion.types import (
     ChatCompletionRequest,
     ChatCompletionResponse,
     SystemMessage,
     UserMessage,
 )
-from not_again_ai.llm.prompting.compile_messages import compile_messages
+import orjson
 from pydantic import BaseModel, Field
 from rich.progress import Progress
 
@@ -16,7 +19,8 @@ from evaluate_ai.evaluation import (
     EvaluationInstanceOutput,
     EvaluationRunConfig,
 )
-from evaluate_ai.utils import Provider, get_llm_client
+from evaluate_ai.tinydb_helpers.verdict_cache import get_verdict_cache
+from evaluate_ai.utils import Provider, parse_messages, render_messages
 
 RESPONSE_MESSAGES = [
     SystemMessage(
@@ -28,13 +32,15 @@ RESPONSE_MESSAGES = [
         content="""{{prompt}}""",
     ),
 ]
+RESPONSE_MESSAGES_TEMPLATES = parse_messages(RESPONSE_MESSAGES)
 
 EVALUATION_MESSAGES = [
     SystemMessage(
         role="system",
         content="""You are evaluating how well a response meets a given criteria. Each can either be met or not met. You must make a choice.
-First, for the criteria, first think step by step about if the response meets the criteria.
-Then as your final answer write down true or false. true means the criteria is met and false means it is not met. \
+First, for the criteria, first think step by step about if the response meets the criteria and write down your reasoning.
+Then as your final answer write down true or false. true means the criteria is met and false means it is not met.
+Your output must be a JSON object with your reasoning first and then your answer: { "reasoning" : "...", "answer" : true } or { "reasoning" : "...", "answer" : false }. \
 Below is an example of the process.
 
 RESPONSE:
@@ -52,8 +58,8 @@ There have been many incredible football games over the years, each memorable fo
 CRITERIA:
 The first two games should not both include the New England Patriots.
 
-SAMPLE ANSWER:
-The first game mentioned, Super Bowl LI, involves the Patriots. The second game, the Tuck Rule Game, also involves the Patriots. Therefore the criteria is NOT met. Therefore the final output is: false""",
+SAMPLE JSON:
+{ "reasoning" : "The first game mentioned, Super Bowl LI, involves the Patriots. The second game, the Tuck Rule Game, also involves the Patriots. Therefore the criteria is NOT met.", "answer" : false }""",
     ),
     UserMessage(
         role="user",
@@ -63,37 +69,82 @@ The first game mentioned, Super Bowl LI, involves the Patriots. The second game,
 CRITERIA:
 {{criteria}}
 
-Now first think step by step if the response meets the criteria and then write either true or false as your final answer.""",
+Now first think step by step if the response meets the criteria and then write either true or false as your final answer, \
+following the JSON format: { "reasoning" : "...", "answer" : true } or { "reasoning" : "...", "answer" : false }""",
     ),
 ]
+EVALUATION_MESSAGES_TEMPLATES = parse_messages(EVALUATION_MESSAGES)
 
-CONVERT_RESPONSE_MESSAGES = [
+
+BATCH_EVALUATION_MESSAGES = [
     SystemMessage(
         role="system",
-        content="""You are a helpful, thoughtful, and meticulous assistant. You will be given text which you must parse out a true or false answer from. 
-Your final output should be a very simple JSON object: { "answer" : true } or { "answer" : false }.
-
-Below is the an example of the process.
-
-RESPONSE:
-The first game mentioned, Super Bowl LI, involves the Patriots. The second game, the Tuck Rule Game, also involves the Patriots. Therefore the criteria is NOT met. Therefore the final output is: false
-
-SAMPLE JSON:
-{ "answer" : false }""",
+        content="""You are evaluating how well a response meets each of a numbered list of criteria. \
+Each can either be met or not met. You must make a choice for every criteria.
+For each criteria, first think step by step about if the response meets it and write down your reasoning.
+Then write down true or false. true means the criteria is met and false means it is not met.
+Your output must be a JSON object with one verdict per criteria, in order, using the criteria's number as its id: \
+{ "verdicts" : [ { "id" : 1, "reasoning" : "...", "answer" : true }, { "id" : 2, "reasoning" : "...", "answer" : false } ] }""",
     ),
     UserMessage(
         role="user",
         content="""RESPONSE:
 {{response}}
 
-Now convert that response into JSON following the format: { "answer" : true } or { "answer" : false }""",
+CRITERIA:
+{{criteria_list}}
+
+Now for each criteria first think step by step if the response meets it and then write either true or false as its answer, \
+following the JSON format: { "verdicts" : [ { "id" : 1, "reasoning" : "...", "answer" : true }, ... ] }""",
     ),
 ]
+BATCH_EVALUATION_MESSAGES_TEMPLATES = parse_messages(BATCH_EVALUATION_MESSAGES)
+
+# Part of every cached verdict's key, so changing either judge prompt invalidates the verdicts it produced
+JUDGE_PROMPTS_DIGEST = blake2b(
+    orjson.dumps([m.content for m in (*EVALUATION_MESSAGES, *BATCH_EVALUATION_MESSAGES)]), digest_size=8
+).hexdigest()
+
+# Matches a final true or false answer, either at the end of plain text or as the last value of the JSON verdict
+FINAL_ANSWER_PATTERN = re.compile(r"\b(true|false)\b[\s\"'}.]*$", re.IGNORECASE)
 
 
 class EvaluationRunConfigMeetsCriteria(EvaluationRunConfig):
     evaluation_provider: Provider
     evaluation_model: str
+    max_criteria_concurrency: int = Field(
+        default=4,
+        ge=1,
+        description="The maximum number of criteria judged concurrently by the evaluation model, across all instances.",
+    )
+    cache_verdicts: bool = Field(
+        default=False,
+        description="If set, verdicts are cached on disk and reused when the same response is judged against the same criteria.",
+    )
+    batch_criteria: bool = Field(
+        default=False,
+        description="If set, all criteria of an instance are judged together in a single call to the evaluation model.",
+    )
+    max_batch_completion_tokens: int = Field(
+        default=16384,
+        ge=1,
+        description="The most completion tokens requested for a batched judge call, which otherwise asks for 1000 per criteria.",
+    )
+
+
+class CriteriaVerdict(BaseModel):
+    """The evaluation model's verdict on a single criteria. The reasoning comes first so it is generated before the answer."""
+
+    reasoning: str = ""
+    answer: bool
+
+
+class NumberedCriteriaVerdict(CriteriaVerdict):
+    id: int
+
+
+class CriteriaVerdicts(BaseModel):
+    verdicts: list[NumberedCriteriaVerdict]
 
 
 class SemanticCriteria(BaseModel):
@@ -108,6 +159,14 @@ class EvaluationInstanceMeetsCriteria(EvaluationInstance):
     semantic_criteria: list[SemanticCriteria] = Field(
         description="The semantic criteria to evaluate the model's output against and how much to factor it into the score."
     )
+    pass_threshold: float | None = Field(
+        default=None,
+        description="If set, criteria are judged from most to least important in groups of max_criteria_concurrency, "
+        "and judging stops once the score is known to be above or below this threshold (0-100). "
+        "The score then only counts the criteria judged so far, so it is a lower bound on the full score "
+        "that stays on the correct side of the threshold. Calls are only saved when an instance has more criteria "
+        "than max_criteria_concurrency. Ignored when batch_criteria is set, since all criteria are then judged in a single call.",
+    )
 
 
 class EvaluationConfigMeetsCriteria(EvaluationConfig):
@@ -127,39 +186,51 @@ class EvaluationInstanceOutputMeetsCriteria(EvaluationInstanceOutput):
 
 class EvaluationMeetsCriteria(Evaluation):
     def __init__(self, config: EvaluationConfigMeetsCriteria) -> None:
-        self.config: EvaluationConfigMeetsCriteria = EvaluationConfigMeetsCriteria(**config)
+        self.config: EvaluationConfigMeetsCriteria = EvaluationConfigMeetsCriteria.model_validate(config)
         super().__init__(self.config)
+        # Criteria are independent, so each is judged in a pool shared by all instances. Created for each call to execute.
+        self._criteria_executor: ThreadPoolExecutor | None = None
+        self._verdict_cache = get_verdict_cache() if self.config.run_config.cache_verdicts else None
 
     def _get_output_class(self) -> type[EvaluationInstanceOutput]:
         return EvaluationInstanceOutputMeetsCriteria
 
-    def execute(self, progress: Progress, keys_to_skip: set) -> None:
-        for provider, model in self.models:
-            for e_instance in self.config.evaluation_instances:
-                key = (EvaluationInstanceOutputMeetsCriteria.__name__, model, provider.value, e_instance.name)
-                if key not in keys_to_skip:
-                    response = self._get_response(prompt=e_instance.prompt, model=model, provider=provider.value)
-                    message = response.choices[0].message.content
-                    score = self._evaluate(message, e_instance)
-                    instance_output = EvaluationInstanceOutputMeetsCriteria(
-                        module_name=self.config.run_config.module_name,
-                        class_name=EvaluationInstanceOutputMeetsCriteria.__name__,
-                        name_model=model,
-                        provider=provider.value,
-                        evaluation_instance=e_instance,
-                        message=message,
-                        score=score,
-                        prompt_tokens_total=response.prompt_tokens,
-                        completion_tokens_total=response.completion_tokens,
-                        duration_sec_total=response.response_duration,
-                    )
-                    instance_output.save_to_db()
-                    progress.advance(0)
-
-    def _get_response(self, prompt: str, model: str, provider: str) -> ChatCompletionResponse:
-        messages = compile_messages(
-            messages=RESPONSE_MESSAGES,
-            variables={"prompt": prompt},
+    def execute(self, progress: Progress, keys_to_skip: frozenset[tuple[str, str, str, str]]) -> None:
+        """Execute the evaluation, judging criteria in a pool that is shut down once every instance is done."""
+        with ThreadPoolExecutor(max_workers=self.config.run_config.max_criteria_concurrency) as executor:
+            self._criteria_executor = executor
+            try:
+                super().execute(progress, keys_to_skip)
+            finally:
+                self._criteria_executor = None
+
+    def _run_instance(
+        self, provider: Provider, model: str, e_instance: EvaluationInstanceMeetsCriteria
+    ) -> EvaluationInstanceOutputMeetsCriteria:
+        # Instances with the same prompt share one response per model
+        response = self._coalesce(
+            (provider, model, e_instance.prompt),
+            lambda: self._get_response(prompt=e_instance.prompt, model=model, provider=provider),
+        )
+        message = response.choices[0].message.content
+        score = self._evaluate(message, e_instance)
+        return EvaluationInstanceOutputMeetsCriteria.model_construct(
+            module_name=self.config.run_config.module_name,
+            class_name=EvaluationInstanceOutputMeetsCriteria.__name__,
+            name_model=model,
+            provider=provider,
+            evaluation_instance=e_instance,
+            message=message,
+            score=score,
+            prompt_tokens_total=response.prompt_tokens,
+            completion_tokens_total=response.completion_tokens,
+            duration_sec_total=response.response_duration,
+        )
+
+    def _get_response(self, prompt: str, model: str, provider: Provider) -> ChatCompletionResponse:
+        messages = render_messages(
+            RESPONSE_MESSAGES_TEMPLATES,
+            {"prompt": prompt},
         )
         request = ChatCompletionRequest(
             messages=messages,
@@ -167,55 +238,153 @@ class EvaluationMeetsCriteria(Evaluation):
             temperature=0.5,
             max_completion_tokens=1500,
         )
-        response = chat_completion(request, provider=provider, client=get_llm_client(provider))
+        response = self._chat_completion(request, provider)
         return response
 
     def _evaluate(self, response_message: str, e_instance: EvaluationInstanceMeetsCriteria) -> float:
-        provider = self.config.run_config.evaluation_provider.value
-        model = self.config.run_config.evaluation_model
+        # Normalize the importance values from parameters to sum to 100
+        scale = 100 / sum(c.importance for c in e_instance.semantic_criteria)
+        if e_instance.pass_threshold is not None and not self.config.run_config.batch_criteria:
+            return self._evaluate_until_decided(response_message, e_instance, scale)
+
+        criteria_met = self._judge_criteria(response_message, [c.criteria for c in e_instance.semantic_criteria])
+        return sum(
+            crit.importance * scale
+            for crit, is_met in zip(e_instance.semantic_criteria, criteria_met, strict=True)
+            if is_met
+        )
+
+    def _evaluate_until_decided(
+        self, response_message: str, e_instance: EvaluationInstanceMeetsCriteria, scale: float
+    ) -> float:
+        """Judges the criteria from most to least important and stops once the remaining criteria
+        can no longer move the score across the instance's pass threshold.
+        Criteria are judged in windows of max_criteria_concurrency and the threshold is checked between windows,
+        so every verdict that was paid for counts towards the score.
+        """
+        ordered = sorted(e_instance.semantic_criteria, key=lambda c: c.importance, reverse=True)
+        window = self.config.run_config.max_criteria_concurrency
 
         score = 0
-        # Normalize the importance values from parameters to sum to 100
-        total_importance = sum([c.importance for c in e_instance.semantic_criteria])
-        for crit in e_instance.semantic_criteria:
-            importance = crit.importance
-            importance = (importance / total_importance) * 100
-            reasoning_messages = compile_messages(
-                messages=EVALUATION_MESSAGES,
-                variables={
-                    "response": response_message,
-                    "criteria": crit.criteria,
-                },
-            )
-            request = ChatCompletionRequest(
-                messages=reasoning_messages,
-                model=model,
-                max_completion_tokens=1000,
-                temperature=0.3,
-            )
-            reasoning = chat_completion(request, provider=provider, client=get_llm_client(provider))
-
-            # Convert the reasoning to JSON
-            convert_messages = compile_messages(
-                messages=CONVERT_RESPONSE_MESSAGES,
-                variables={
-                    "response": reasoning.choices[0].message.content,
-                },
-            )
-            request = ChatCompletionRequest(
-                messages=convert_messages,
-                model=model,
-                max_completion_tokens=500,
-                temperature=0,
-                json_mode=True,
+        remaining = 100
+        for start in range(0, len(ordered), window):
+            batch = ordered[start : start + window]
+            verdicts = self._criteria_executor.map(lambda c: self._judge_criterion(response_message, c.criteria), batch)
+            for crit, is_met in zip(batch, verdicts, strict=True):
+                importance = crit.importance * scale
+                remaining -= importance
+                if is_met:
+                    score += importance
+            if score >= e_instance.pass_threshold or score + remaining < e_instance.pass_threshold:
+                break
+        return score
+
+    def _judge_criterion(self, response_message: str, criteria: str) -> bool:
+        """Returns whether the response meets a single criteria, using the cached verdict if available."""
+        if self._verdict_cache is None:
+            return bool(self._meets_criteria(response_message, criteria))
+
+        key = self._verdict_key(response_message, criteria)
+        is_met = self._verdict_cache.get(key)
+        if is_met is None:
+            is_met = self._meets_criteria(response_message, criteria)
+            if is_met is None:
+                return False
+            self._verdict_cache.put(key, is_met)
+        return is_met
+
+    def _judge_criteria(self, response_message: str, criteria: list[str]) -> list[bool]:
+        """Returns whether the response meets each criteria, using cached verdicts where available."""
+        criteria_met: list[bool | None] = [None] * len(criteria)
+        if self._verdict_cache is not None:
+            keys = [self._verdict_key(response_message, c) for c in criteria]
+            criteria_met = [self._verdict_cache.get(key) for key in keys]
+
+        uncached = [i for i, is_met in enumerate(criteria_met) if is_met is None]
+        if not uncached:
+            return criteria_met
+
+        if self.config.run_config.batch_criteria:
+            verdicts = self._meets_all_criteria(response_message, [criteria[i] for i in uncached])
+        else:
+            verdicts = self._criteria_executor.map(
+                lambda i: self._meets_criteria(response_message, criteria[i]), uncached
             )
-            evaluation_result = chat_completion(request, provider=provider, client=get_llm_client(provider))
+        for i, verdict in zip(uncached, verdicts, strict=True):
+            # Criteria without a parseable verdict count as not met, but are not cached so a later run judges them again
+            criteria_met[i] = bool(verdict)
+            if self._verdict_cache is not None and verdict is not None:
+                self._verdict_cache.put(keys[i], verdict)
+        return criteria_met
+
+    def _verdict_key(self, response_message: str, criteria: str) -> str:
+        provider = self.config.run_config.evaluation_provider
+        model = self.config.run_config.evaluation_model
+        return self._verdict_cache.make_key(JUDGE_PROMPTS_DIGEST, provider.value, model, criteria, response_message)
 
-            try:
-                evaluation_result = evaluation_result.choices[0].json_message["answer"]
-                if evaluation_result:
-                    score += importance
-            except Exception:
-                continue
+    def _meets_criteria(self, response_message: str, criteria: str) -> bool | None:
+        """Asks the evaluation model whether the response meets a single criteria.
+        Returns None if the evaluation model's output has no parseable verdict.
+        """
+        model = self.config.run_config.evaluation_model
 
-        return score
+        messages = render_messages(
+            EVALUATION_MESSAGES_TEMPLATES,
+            {
+                "response": response_message,
+                "criteria": criteria,
+            },
+        )
+        # Reason and give the verdict as JSON in a single call
+        request = ChatCompletionRequest(
+            messages=messages,
+            model=model,
+            max_completion_tokens=1000,
+            temperature=0.3,
+            json_mode=True,
+        )
+        evaluation_result = self._judge(request)
+
+        try:
+            return CriteriaVerdict.model_validate(evaluation_result.choices[0].json_message).answer
+        except Exception:
+            # Recover the answer locally when the verdict is not valid JSON instead of asking again
+            match = FINAL_ANSWER_PATTERN.search(evaluation_result.choices[0].message.content or "")
+            return None if match is None else match.group(1).lower() == "true"
+
+    def _meets_all_criteria(self, response_message: str, criteria: list[str]) -> list[bool | None]:
+        """Asks the evaluation model whether the response meets each criteria in one call,
+        which sends the response once instead of once per criteria.
+        Criteria without a parseable verdict are None.
+        """
+        model = self.config.run_config.evaluation_model
+
+        messages = render_messages(
+            BATCH_EVALUATION_MESSAGES_TEMPLATES,
+            {
+                "response": response_message,
+                "criteria_list": "\n".join(f"{i}. {c}" for i, c in enumerate(criteria, start=1)),
+            },
+        )
+        request = ChatCompletionRequest(
+            messages=messages,
+            model=model,
+            max_completion_tokens=min(1000 * len(criteria), self.config.run_config.max_batch_completion_tokens),
+            temperature=0.3,
+            json_mode=True,
+        )
+        evaluation_result = self._judge(request)
+
+        criteria_met: list[bool | None] = [None] * len(criteria)
+        try:
+            verdicts = CriteriaVerdicts.model_validate(evaluation_result.choices[0].json_message).verdicts
+        except Exception:
+            return criteria_met
+        for verdict in verdicts:
+            if 1 <= verdict.id <= len(criteria):
+                criteria_met[verdict.id - 1] = verdict.answer
+        return criteria_met
+
+    def _judge(self, request: ChatCompletionRequest) -> ChatCompletionResponse:
+        """Sends a request to the evaluation model."""
+        return self._chat_completion(request, self.config.run_config.evaluation_provider)
@@ -2,10 +2,8 @@
 
 import re
 
-from not_again_ai.llm.chat_completion import chat_completion
 from not_again_ai.llm.chat_completion.types import ChatCompletionRequest, ChatCompletionResponse, UserMessage
 from pydantic import Field
-from rich.progress import Progress
 
 from evaluate_ai.evaluation import (
     Evaluation,
@@ -14,7 +12,14 @@ from evaluate_ai.evaluation import (
     EvaluationInstanceOutput,
     EvaluationRunConfig,
 )
-from evaluate_ai.utils import download_parquet, get_llm_client
+from evaluate_ai.utils import Provider, iter_parquet
+
+CHOICE_MAP = "ABCDEFGHIJ"
+
+# Answer extraction patterns, tried in order: "answer is (X)", then "Answer: X", then the last standalone letter
+ANSWER_IS_PATTERN = re.compile(r"answer is \(?([A-J])\)?")
+ANSWER_COLON_PATTERN = re.compile(r".*[aA]nswer:\s*([A-J])")
+LAST_LETTER_PATTERN = re.compile(r"\b[A-J]\b(?!.*\b[A-J]\b)", re.DOTALL)
 
 
 class EvaluationInstanceMMLUPro(EvaluationInstance):
@@ -30,6 +35,11 @@ class EvaluationRunConfigMMLUPro(EvaluationRunConfig):
     data_url: str = Field(
         description="The URL to the data file.",
     )
+    keep_full_message: bool = Field(
+        default=True,
+        description="If not set, only the extracted answer is saved instead of the model's full step by step response, "
+        "which keeps the results database much smaller.",
+    )
 
 
 class EvaluationConfigMMLUPro(EvaluationConfig):
@@ -47,6 +57,7 @@ class EvaluationInstanceOutputMMLUPro(EvaluationInstanceOutput):
 
     evaluation_instance: EvaluationInstanceMMLUPro
     message: str
+    extracted_answer: str | None = None
     prompt_tokens_total: int
     completion_tokens_total: int
     duration_sec_total: float
@@ -54,76 +65,81 @@ class EvaluationInstanceOutputMMLUPro(EvaluationInstanceOutput):
 
 class MMLUProEvaluation(Evaluation):
     def __init__(self, config: EvaluationConfigMMLUPro) -> None:
-        self.config: EvaluationConfigMMLUPro = EvaluationConfigMMLUPro(**config)
+        self.config: EvaluationConfigMMLUPro = EvaluationConfigMMLUPro.model_validate(config)
         super().__init__(self.config)
 
         # Extract the file name from the URL
         file_name = self.config.run_config.data_url.split("/")[-1]
-        self.data = download_parquet(self.config.run_config.data_url, file_name)
-        # Create the evaluation instances from the downloaded data
-        for row in self.data:
-            instance_data = {
-                "name": str(row["question_id"]),
-                "question": row["question"],
-                "options": row["options"],
-                "category": row["category"],
-                "answer": row["answer"],
-            }
-            self.config.evaluation_instances.append(EvaluationInstanceMMLUPro(**instance_data))
+        rows = iter_parquet(
+            self.config.run_config.data_url,
+            file_name,
+            columns=["question_id", "question", "options", "category", "answer"],
+        )
+        # Create the evaluation instances while streaming the downloaded data
+        self.config.evaluation_instances.extend(
+            EvaluationInstanceMMLUPro(
+                name=str(row["question_id"]),
+                question=row["question"],
+                options=row["options"],
+                category=row["category"],
+                answer=row["answer"],
+            )
+            for row in rows
+        )
 
     def _get_output_class(self) -> type[EvaluationInstanceOutput]:
         return EvaluationInstanceOutputMMLUPro
 
-    def execute(self, progress: Progress, keys_to_skip: set) -> None:
-        """Execute the evaluation for each model and instance."""
-        for provider, model in self.models:
-            for e_instance in self.config.evaluation_instances:
-                key = (EvaluationInstanceOutputMMLUPro.__name__, model, provider.value, e_instance.name)
-                if key not in keys_to_skip:
-                    response = self._get_response(
-                        e_instance.question,
-                        e_instance.options,
-                        e_instance.category,
-                        model,
-                        provider.value,
-                    )
-
-                    try:
-                        score = self._evaluate(response.choices[0].message.content, e_instance.answer)
-                    except Exception:
-                        score = 0
-
-                    instance_output = EvaluationInstanceOutputMMLUPro(
-                        module_name=self.config.run_config.module_name,
-                        class_name=EvaluationInstanceOutputMMLUPro.__name__,
-                        name_model=model,
-                        provider=provider.value,
-                        evaluation_instance=e_instance,
-                        message=response.choices[0].message.content,
-                        score=score,
-                        prompt_tokens_total=response.prompt_tokens,
-                        completion_tokens_total=response.completion_tokens,
-                        duration_sec_total=response.response_duration,
-                    )
-                    instance_output.save_to_db()
-                    progress.advance(0)
+    def _run_instance(
+        self, provider: Provider, model: str, e_instance: EvaluationInstanceMMLUPro
+    ) -> EvaluationInstanceOutputMMLUPro:
+        """Execute the evaluation instance against the model."""
+        response = self._get_response(
+            e_instance.question,
+            e_instance.options,
+            e_instance.category,
+            model,
+            provider,
+        )
+
+        message = response.choices[0].message.content
+        try:
+            extracted_answer = self._extract_answer(message)
+        except Exception:
+            extracted_answer = None
+        score = self._evaluate(extracted_answer, e_instance.answer)
+
+        return EvaluationInstanceOutputMMLUPro.model_construct(
+            module_name=self.config.run_config.module_name,
+            class_name=EvaluationInstanceOutputMMLUPro.__name__,
+            name_model=model,
+            provider=provider,
+            evaluation_instance=e_instance,
+            message=message if self.config.run_config.keep_full_message else "",
+            extracted_answer=extracted_answer,
+            score=score,
+            prompt_tokens_total=response.prompt_tokens,
+            completion_tokens_total=response.completion_tokens,
+            duration_sec_total=response.response_duration,
+        )
 
     def _get_response(
-        self, question: str, options: list[str], category: str, model: str, provider: str
+        self, question: str, options: list[str], category: str, model: str, provider: Provider
     ) -> ChatCompletionResponse:
-        prompt = f"""The following are multiple choice questions (with answers) about {category}. Think step by \
-step and then output the answer in the format of "The answer is (X)" at the end.\n\n"""
-        prompt += f"Question: {question}\nOptions:\n"
-
-        choice_map = "ABCDEFGHIJ"
-        for i, opt in enumerate(options):
-            prompt += f"{choice_map[i]}. {opt}\n"
-
-        prompt += "\nAnswer: Let's think step by step.\n"
+        # The instructions come first so prompts of the same category share a prefix for provider prompt caching
+        prompt = "".join(
+            [
+                f"""The following are multiple choice questions (with answers) about {category}. Think step by \
+step and then output the answer in the format of "The answer is (X)" at the end.\n\n""",
+                f"Question: {question}\nOptions:\n",
+                *(f"{CHOICE_MAP[i]}. {opt}\n" for i, opt in enumerate(options)),
+                "\nAnswer: Let's think step by step.\n",
+            ]
+        )
 
         messages = [
             UserMessage(
-                content=f"{prompt}",
+                content=prompt,
             ),
         ]
         request = ChatCompletionRequest(
@@ -132,38 +148,21 @@ step and then output the answer in the format of "The answer is (X)" at the end.
             temperature=0.7,
             max_completion_tokens=2000,
         )
-        response = chat_completion(request, provider=provider, client=get_llm_client(provider))
+        # A multiple choice answer does not need a fresh sample on every re-run, so it is cached whenever cache_responses is set
+        response = self._chat_completion(request, provider, cache_sampled=True)
         return response
 
-    def _evaluate(self, response: str, expected_value: str) -> float:
-        """Extracts the answer from the model's response and compares it to the expected value."""
-
-        def extract_answer(text):
-            pattern = r"answer is \(?([A-J])\)?"
-            match = re.search(pattern, text)
-            if match:
-                return match.group(1)
-            else:
-                return extract_again(text)
-
-        def extract_again(text):
-            match = re.search(r".*[aA]nswer:\s*([A-J])", text)
-            if match:
-                return match.group(1)
-            else:
-                return extract_final(text)
-
-        def extract_final(text):
-            pattern = r"\b[A-J]\b(?!.*\b[A-J]\b)"
-            match = re.search(pattern, text, re.DOTALL)
-            if match:
-                return match.group(0)
-            else:
-                return None
-
+    def _extract_answer(self, response: str) -> str | None:
+        """Extracts the letter of the chosen option from the model's response."""
         response = response.replace("**", "")
-        extracted_answer = extract_answer(response)
-
+        match = ANSWER_IS_PATTERN.search(response) or ANSWER_COLON_PATTERN.search(response)
+        if match:
+            return match.group(1)
+        match = LAST_LETTER_PATTERN.search(response)
+        return match.group(0) if match else None
+
+    def _evaluate(self, extracted_answer: str | None, expected_value: str) -> float:
+        """Compares the answer extracted from the model's response to the expected value."""
         if extracted_answer is None:
             return 0
         elif extracted_answer == expected_value:
@@ -1,22 +1,21 @@
-import json
 from typing import Any
 
 from jsonschema import validate
-from jsonschema.exceptions import SchemaError, ValidationError
+from jsonschema.exceptions import SchemaError, ValidationError, best_match
+from jsonschema.protocols import Validator
+from jsonschema.validators import validator_for
 from loguru import logger
-from not_again_ai.llm.chat_completion import chat_completion
 from not_again_ai.llm.chat_completion.types import (
     ChatCompletionRequest,
     ChatCompletionResponse,
     SystemMessage,
     UserMessage,
 )
-from not_again_ai.llm.prompting.compile_messages import compile_messages
-from pydantic import Field
-from rich.progress import Progress
+import orjson
+from pydantic import Field, PrivateAttr
 
 from evaluate_ai.evaluation import Evaluation, EvaluationConfig, EvaluationInstance, EvaluationInstanceOutput
-from evaluate_ai.utils import get_llm_client
+from evaluate_ai.utils import Provider, parse_messages, render_messages
 
 STRUCTURED_OUTPUT_MESSAGES = [
     SystemMessage(
@@ -28,6 +27,7 @@ STRUCTURED_OUTPUT_MESSAGES = [
         content="""{{prompt}}""",
     ),
 ]
+STRUCTURED_OUTPUT_MESSAGES_TEMPLATES = parse_messages(STRUCTURED_OUTPUT_MESSAGES)
 
 
 class EvaluationInstanceStructuredOutput(EvaluationInstance):
@@ -35,6 +35,25 @@ class EvaluationInstanceStructuredOutput(EvaluationInstance):
         description="The prompt to present to the model.",
     )
     json_schema: dict[str, Any] = Field(description="The schema to validate the model's output against.")
+    _validator: Validator = PrivateAttr()
+    _required_properties: tuple[str, ...] | None = PrivateAttr(default=None)
+
+    def model_post_init(self, __context: Any) -> None:
+        # Check and build the validator once at load time since the schema is reused for every model
+        validator_class = validator_for(self.json_schema)
+        validator_class.check_schema(self.json_schema)
+        self._validator = validator_class(self.json_schema)
+        if self.json_schema.get("type") == "object":
+            self._required_properties = tuple(self.json_schema.get("required", ()))
+
+    @property
+    def validator(self) -> Validator:
+        return self._validator
+
+    @property
+    def required_properties(self) -> tuple[str, ...] | None:
+        """The properties a response must have if the schema expects an object, otherwise None."""
+        return self._required_properties
 
 
 class EvaluationConfigStructuredOutput(EvaluationConfig):
@@ -54,43 +73,39 @@ class EvaluationInstanceOutputStructuredOutput(EvaluationInstanceOutput):
 
 class EvaluationStructuredOutput(Evaluation):
     def __init__(self, config: EvaluationConfigStructuredOutput) -> None:
-        self.config: EvaluationConfigStructuredOutput = EvaluationConfigStructuredOutput(**config)
+        self.config: EvaluationConfigStructuredOutput = EvaluationConfigStructuredOutput.model_validate(config)
         super().__init__(self.config)
 
     def _get_output_class(self) -> type[EvaluationInstanceOutput]:
         return EvaluationInstanceOutputStructuredOutput
 
-    def execute(self, progress: Progress, keys_to_skip: set) -> None:
-        for provider, model in self.models:
-            for e_instance in self.config.evaluation_instances:
-                key = (EvaluationInstanceOutputStructuredOutput.__name__, model, provider.value, e_instance.name)
-                if key not in keys_to_skip:
-                    response = self._get_response(
-                        prompt=e_instance.prompt,
-                        model=model,
-                        provider=provider.value,
-                    )
-                    message = response.choices[0].message.content
-                    score, error = self._evaluate(message, e_instance.json_schema)
-                    instance_output = EvaluationInstanceOutputStructuredOutput(
-                        module_name=self.config.run_config.module_name,
-                        class_name=EvaluationInstanceOutputStructuredOutput.__name__,
-                        name_model=model,
-                        provider=provider,
-                        evaluation_instance=e_instance,
-                        message=str(message),
-                        error_message=error,
-                        score=score,
-                        prompt_tokens_total=response.prompt_tokens,
-                        completion_tokens_total=response.completion_tokens,
-                        duration_sec_total=response.response_duration,
-                    )
-                    instance_output.save_to_db()
-                    progress.advance(0)
-
-    def _get_response(self, prompt: str, model: str, provider: str) -> ChatCompletionResponse:
-        messages = compile_messages(
-            messages=STRUCTURED_OUTPUT_MESSAGES,
+    def _run_instance(
+        self, provider: Provider, model: str, e_instance: EvaluationInstanceStructuredOutput
+    ) -> EvaluationInstanceOutputStructuredOutput:
+        response = self._get_response(
+            prompt=e_instance.prompt,
+            model=model,
+            provider=provider,
+        )
+        message = response.choices[0].message.content
+        score, error = self._evaluate(message, e_instance)
+        return EvaluationInstanceOutputStructuredOutput.model_construct(
+            module_name=self.config.run_config.module_name,
+            class_name=EvaluationInstanceOutputStructuredOutput.__name__,
+            name_model=model,
+            provider=provider,
+            evaluation_instance=e_instance,
+            message=str(message),
+            error_message=error,
+            score=score,
+            prompt_tokens_total=response.prompt_tokens,
+            completion_tokens_total=response.completion_tokens,
+            duration_sec_total=response.response_duration,
+        )
+
+    def _get_response(self, prompt: str, model: str, provider: Provider) -> ChatCompletionResponse:
+        messages = render_messages(
+            STRUCTURED_OUTPUT_MESSAGES_TEMPLATES,
             variables={
                 "prompt": prompt,
             },
@@ -102,15 +117,37 @@ class EvaluationStructuredOutput(Evaluation):
             max_tokens=2000,
             json_mode=True,
         )
-        response = chat_completion(request, provider=provider, client=get_llm_client(provider))
+        # Re-runs usually change the schema rather than the prompt, so the cached response is validated again instead of sampling a new one
+        response = self._chat_completion(request, provider, cache_sampled=True)
         return response
 
-    def _evaluate(self, response: dict, json_schema: dict) -> tuple[float, str | None]:
+    def _evaluate(
+        self, response: str | None, e_instance: EvaluationInstanceStructuredOutput
+    ) -> tuple[float, str | None]:
+        # Such as when the model refuses or returns an empty reply
+        if response is None:
+            return (0, "Response has no content")
+
+        # The schema applies to the parsed JSON, not to the message string itself
         try:
-            validate(instance=response, schema=json_schema)
+            parsed_response = orjson.loads(response)
+        except orjson.JSONDecodeError as e:
+            return (0, f"Response is not valid JSON: {e}")
+
+        # Reject responses with the wrong shape without walking the whole schema
+        required_properties = e_instance.required_properties
+        if required_properties is not None:
+            if not isinstance(parsed_response, dict):
+                return (0, "Response is not a JSON object")
+            missing_properties = [key for key in required_properties if key not in parsed_response]
+            if missing_properties:
+                return (0, f"Response is missing required properties: {missing_properties}")
+
+        # Report the same error that jsonschema's validate would raise
+        error = best_match(e_instance.validator.iter_errors(parsed_response))
+        if error is None:
             return (100, None)
-        except ValidationError as e:
-            return (0, str(e))
+        return (0, str(error))
 
     @staticmethod
     def test_schema(sample_model_response: str | dict, json_schema: dict) -> None:
@@ -122,8 +159,8 @@ class EvaluationStructuredOutput(Evaluation):
         """
         if isinstance(sample_model_response, str):
             try:
-                sample_model_response = json.loads(sample_model_response)
-            except json.JSONDecodeError as e:
+                sample_model_response = orjson.loads(sample_model_response)
+            except orjson.JSONDecodeError as e:
                 logger.error(f"Could not parse the sample model response into a Python dictionary: {e}")
                 return
 
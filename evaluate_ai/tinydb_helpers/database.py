@@ -0,0 +1,41 @@
+import atexit
+from functools import cache
+from threading import Lock
+
+from tinydb import TinyDB
+from tinydb.middlewares import CachingMiddleware
+from tinydb.storages import JSONStorage
+
+from evaluate_ai.tinydb_helpers.db_path import LEGACY_TINYDB_PATH, TINYDB_PATH
+from evaluate_ai.tinydb_helpers.storage import JSONLinesStorage, JSONLinesTinyDB
+
+# TinyDB is not thread-safe, so writers that may run concurrently, such as evaluations run in parallel, hold this lock.
+DB_LOCK = Lock()
+
+
+@cache
+def get_db() -> TinyDB:
+    """Returns the TinyDB database shared by the whole process.
+    The database file is parsed once and then served from memory by CachingMiddleware.
+    Writers should call `db.storage.flush()` once they are done writing a batch of documents.
+
+    Returns:
+        TinyDB: The shared database instance.
+    """
+    if not TINYDB_PATH.exists() and LEGACY_TINYDB_PATH.exists():
+        _migrate_legacy_db()
+
+    db = JSONLinesTinyDB(TINYDB_PATH, storage=CachingMiddleware(JSONLinesStorage))
+    atexit.register(db.close)
+    return db
+
+
+def _migrate_legacy_db() -> None:
+    """Copies the documents of a database written with TinyDB's JSONStorage into the JSON lines database.
+    The legacy file is left in place.
+    """
+    legacy_storage = JSONStorage(LEGACY_TINYDB_PATH, access_mode="r")
+    data = legacy_storage.read()
+    legacy_storage.close()
+    if data:
+        JSONLinesStorage(TINYDB_PATH).write(data)
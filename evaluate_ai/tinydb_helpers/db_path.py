@@ -1,3 +1,10 @@
 from pathlib import Path
 
-TINYDB_PATH = Path(__file__).parent.parent.parent / "data" / "tinydb.json"
+DATA_PATH = Path(__file__).parent.parent.parent / "data"
+TINYDB_PATH = DATA_PATH / "tinydb.jsonl"
+# Databases written before results were stored as JSON lines
+LEGACY_TINYDB_PATH = DATA_PATH / "tinydb.json"
+# Verdicts of the meets criteria evaluation model, kept apart from the results database
+VERDICT_CACHE_PATH = DATA_PATH / "verdict_cache.jsonl"
+# LLM responses reused across runs when response caching is enabled
+RESPONSE_CACHE_PATH = DATA_PATH / "response_cache.jsonl"
@@ -0,0 +1,66 @@
+import atexit
+from functools import cache
+from hashlib import blake2b
+from pathlib import Path
+from threading import Lock
+from typing import Any
+
+from not_again_ai.llm.chat_completion.types import ChatCompletionRequest, ChatCompletionResponse
+import orjson
+from tinydb.middlewares import CachingMiddleware
+
+from evaluate_ai.tinydb_helpers.db_path import RESPONSE_CACHE_PATH
+from evaluate_ai.tinydb_helpers.storage import JSONLinesStorage, JSONLinesTinyDB
+
+# Part of every key, so bumping it invalidates responses cached in an older format
+RESPONSE_CACHE_VERSION = 1
+
+
+class ResponseCache:
+    """Persists LLM responses in their own TinyDB database so that re-runs
+    do not send a request that was already answered with an identical one.
+    Safe to use from multiple threads.
+    """
+
+    def __init__(self, path: Path = RESPONSE_CACHE_PATH) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = JSONLinesTinyDB(path, storage=CachingMiddleware(JSONLinesStorage))
+        atexit.register(self._db.close)
+        # Responses are validated when they are first read, not when the cache is loaded
+        self._responses: dict[str, dict[str, Any] | ChatCompletionResponse] = {
+            doc["key"]: doc["response"] for doc in self._db.all()
+        }
+        self._lock = Lock()
+
+    @staticmethod
+    def make_key(provider: str, request: ChatCompletionRequest) -> str:
+        """Hashes the provider and every field of the request, such as the model, messages, and sampling parameters."""
+        parts = [RESPONSE_CACHE_VERSION, provider, request.model_dump(mode="json")]
+        return blake2b(orjson.dumps(parts, option=orjson.OPT_SORT_KEYS), digest_size=16).hexdigest()
+
+    def get(self, key: str) -> ChatCompletionResponse | None:
+        response = self._responses.get(key)
+        if isinstance(response, dict):
+            response = self._responses[key] = ChatCompletionResponse.model_validate(response)
+        return response
+
+    def put(self, key: str, response: ChatCompletionResponse) -> None:
+        with self._lock:
+            if key not in self._responses:
+                self._responses[key] = response
+                self._db.insert({"key": key, "response": response.model_dump(mode="json")})
+
+
+_RESPONSE_CACHE_LOCK = Lock()
+
+
+@cache
+def _create_response_cache() -> ResponseCache:
+    return ResponseCache()
+
+
+def get_response_cache() -> ResponseCache:
+    """Returns the response cache shared by every evaluation in the process, so only one database writes to its file."""
+    # Evaluations can be constructed from several threads at once
+    with _RESPONSE_CACHE_LOCK:
+        return _create_response_cache()
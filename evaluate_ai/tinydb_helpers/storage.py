@@ -0,0 +1,109 @@
+from pathlib import Path
+from typing import Any
+
+import orjson
+from tinydb import TinyDB
+from tinydb.middlewares import Middleware
+from tinydb.storages import Storage
+from tinydb.table import Table
+
+
+class JSONLinesStorage(Storage):
+    """A TinyDB storage that keeps one document per line and appends new documents instead of rewriting the file.
+
+    Each line is a JSON array of [table name, document id, document], encoded and decoded with orjson.
+    TinyDB always passes the whole database to `write`, so for each table the number of persisted documents and
+    the highest persisted document id are kept to find the documents a write adds.
+    A write that removes documents rewrites the file, as does a write after `mark_changed`.
+    Documents are updated in place, which cannot be detected here, so use it through `JSONLinesTinyDB`.
+    """
+
+    def __init__(self, path: str | Path) -> None:
+        self._path = Path(path)
+        # Table name to (number of persisted documents, highest persisted document id)
+        self._persisted: dict[str, tuple[int, int]] = {}
+        self._changed = False
+
+    def read(self) -> dict[str, dict[str, Any]] | None:
+        if not self._path.exists():
+            return None
+
+        data: dict[str, dict[str, Any]] = {}
+        with self._path.open("rb") as file:
+            for line in file:
+                if line.strip():
+                    table, doc_id, document = orjson.loads(line)
+                    data.setdefault(table, {})[doc_id] = document
+        self._persisted = {table: (len(documents), max(map(int, documents))) for table, documents in data.items()}
+        return data or None
+
+    def write(self, data: dict[str, dict[str, Any]]) -> None:
+        new_documents = None if self._changed else self._new_documents(data)
+        if new_documents is None:
+            lines = [
+                [table, doc_id, document] for table, documents in data.items() for doc_id, document in documents.items()
+            ]
+            mode = "wb"
+            self._persisted = {}
+        else:
+            lines = new_documents
+            mode = "ab"
+
+        with self._path.open(mode) as file:
+            file.writelines(orjson.dumps(line) + b"\n" for line in lines)
+        for table, doc_id, _ in lines:
+            count, max_id = self._persisted.get(table, (0, 0))
+            self._persisted[table] = (count + 1, max(max_id, int(doc_id)))
+        self._changed = False
+
+    def mark_changed(self) -> None:
+        """Rewrites the whole file on the next write, such as after documents were updated in place."""
+        self._changed = True
+
+    def _new_documents(self, data: dict[str, dict[str, Any]]) -> list[list[Any]] | None:
+        """Returns the documents in data that have not been persisted yet,
+        or None if any persisted document was removed and the file must be rewritten.
+        New documents are the ones with an id above the table's highest persisted id.
+        If the remaining documents do not add up to the persisted count, some were removed or inserted with a lower id.
+        """
+        if self._persisted.keys() - data.keys():
+            return None
+
+        new_documents = []
+        for table, documents in data.items():
+            count, max_id = self._persisted.get(table, (0, 0))
+            table_new_documents = [
+                [table, doc_id, document] for doc_id, document in documents.items() if int(doc_id) > max_id
+            ]
+            if len(documents) - len(table_new_documents) != count:
+                return None
+            new_documents.extend(table_new_documents)
+        return new_documents
+
+
+class JSONLinesTable(Table):
+    """A TinyDB table that tells its JSONLinesStorage to rewrite the file when documents are updated,
+    since updated documents cannot be appended.
+    """
+
+    def update(self, *args: Any, **kwargs: Any) -> list[int]:
+        self._mark_changed()
+        return super().update(*args, **kwargs)
+
+    def update_multiple(self, *args: Any, **kwargs: Any) -> list[int]:
+        self._mark_changed()
+        return super().update_multiple(*args, **kwargs)
+
+    def _mark_changed(self) -> None:
+        storage = self._storage
+        # Unwrap middlewares such as CachingMiddleware
+        while isinstance(storage, Middleware):
+            storage = storage.storage
+        if isinstance(storage, JSONLinesStorage):
+            storage.mark_changed()
+
+
+class JSONLinesTinyDB(TinyDB):
+    """TinyDB with tables that keep a JSONLinesStorage correct when documents are updated."""
+
+    table_class = JSONLinesTable
@@ -0,0 +1,59 @@
+import atexit
+from functools import cache
+from hashlib import blake2b
+from pathlib import Path
+from threading import Lock
+
+import orjson
+from tinydb.middlewares import CachingMiddleware
+
+from evaluate_ai.tinydb_helpers.db_path import VERDICT_CACHE_PATH
+from evaluate_ai.tinydb_helpers.storage import JSONLinesStorage, JSONLinesTinyDB
+
+# Part of every key, so bumping it invalidates verdicts cached in an older format
+VERDICT_CACHE_VERSION = 1
+
+
+class VerdictCache:
+    """Persists evaluation model verdicts in their own TinyDB database so that re-runs
+    do not ask the evaluation model to judge the same response against the same criteria again.
+    Safe to use from multiple threads.
+    """
+
+    def __init__(self, path: Path = VERDICT_CACHE_PATH) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = JSONLinesTinyDB(path, storage=CachingMiddleware(JSONLinesStorage))
+        atexit.register(self._db.close)
+        self._verdicts: dict[str, bool] = {doc["key"]: doc["verdict"] for doc in self._db.all()}
+        self._lock = Lock()
+
+    @staticmethod
+    def make_key(*parts: str) -> str:
+        """Hashes the parts identifying a verdict, such as the provider, model, criteria, and response,
+        so long responses are not stored as keys.
+        """
+        return blake2b(orjson.dumps([VERDICT_CACHE_VERSION, *parts]), digest_size=16).hexdigest()
+
+    def get(self, key: str) -> bool | None:
+        return self._verdicts.get(key)
+
+    def put(self, key: str, verdict: bool) -> None:
+        with self._lock:
+            if key not in self._verdicts:
+                self._verdicts[key] = verdict
+                self._db.insert({"key": key, "verdict": verdict})
+
+
+_VERDICT_CACHE_LOCK = Lock()
+
+
+@cache
+def _create_verdict_cache() -> VerdictCache:
+    return VerdictCache()
+
+
+def get_verdict_cache() -> VerdictCache:
+    """Returns the verdict cache shared by every evaluation in the process, so only one database writes to its file."""
+    # Evaluations can be constructed from several threads at once
+    with _VERDICT_CACHE_LOCK:
+        return _create_verdict_cache()
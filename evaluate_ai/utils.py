@@ -1,14 +1,36 @@
+from collections.abc import Callable, Iterator
 from enum import Enum
-import json
 from pathlib import Path
+import tempfile
+from threading import Lock
+import time
 from typing import Any
 
+from liquid import BoundTemplate, Template
 from loguru import logger
+from not_again_ai.llm.chat_completion.types import MessageT
+import orjson
 import pyarrow.parquet as pq
 import requests
 from tenacity import retry, stop_after_attempt, wait_exponential
+import yaml
 
-from evaluate_ai.constants import AZURE_OPENAI_CLIENT, OLLAMA_CLIENT, OPENAI_CLIENT
+from evaluate_ai import constants
+
+# Use the LibYAML based loader when PyYAML was built with it, which is considerably faster than the pure Python one.
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+# Directory where downloaded datasets are cached
+TEMP_DATA_PATH = Path(__file__).parents[1] / "data" / "temp"
+# Reuses connections across downloads instead of opening a new one for every file
+_SESSION = requests.Session()
+# (connect, read) timeouts in seconds. The read timeout bounds each wait for data, not the whole download.
+_DOWNLOAD_TIMEOUT = (10, 60)
+# Revalidating a cached file is optional, so give up quickly and fall back to the cached file
+_REVALIDATE_TIMEOUT = (3, 10)
 
 
 class Provider(Enum):
@@ -16,23 +38,126 @@ class Provider(Enum):
     OLLAMA = "ollama"
     OPENAI = "openai_api"
 
+    @property
+    def chat_completion_name(self) -> str:
+        """The provider name expected by not_again_ai's chat_completion, which differs from the stored value for OpenAI."""
+        return "openai" if self is Provider.OPENAI else self.value
 
-def get_llm_client(provider_name: str) -> Any:
-    if provider_name == Provider.OLLAMA.value:
-        llm_client = OLLAMA_CLIENT
-    elif provider_name == Provider.OPENAI.value:
-        llm_client = OPENAI_CLIENT
-    elif provider_name == Provider.AZURE_OPENAI.value:
-        llm_client = AZURE_OPENAI_CLIENT
-    else:
-        raise ValueError(f"Provider {provider_name} is not supported.")
 
-    return llm_client
+# The constants attribute holding each provider's client, which is created once on first access
+_CLIENT_NAMES = {
+    Provider.OLLAMA: "OLLAMA_CLIENT",
+    Provider.OPENAI: "OPENAI_CLIENT",
+    Provider.AZURE_OPENAI: "AZURE_OPENAI_CLIENT",
+}
+
+
+def get_llm_client(provider: Provider) -> Any:
+    client_name = _CLIENT_NAMES.get(provider)
+    if client_name is None:
+        raise ValueError(f"Provider {provider} is not supported.")
+    return getattr(constants, client_name)
+
+
+class RateLimiter:
+    """Spaces out calls evenly so that at most `requests_per_minute` start in any minute, across all threads."""
+
+    def __init__(self, requests_per_minute: int) -> None:
+        self._interval = 60 / requests_per_minute
+        self._next_start = time.monotonic()
+        self._lock = Lock()
+
+    def acquire(self) -> None:
+        """Blocks until the caller is allowed to start its request."""
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._next_start, now)
+            self._next_start = start + self._interval
+        if start > now:
+            time.sleep(start - now)
+
+    def limit(self, llm_client: Callable[..., Any]) -> Callable[..., Any]:
+        """Wraps an LLM client so that each request waits for the rate limiter first."""
+
+        def client_callable(**kwargs: Any) -> Any:
+            self.acquire()
+            return llm_client(**kwargs)
+
+        return client_callable
+
+
+_RATE_LIMITERS: dict[tuple[Provider, int], RateLimiter] = {}
+_RATE_LIMITERS_LOCK = Lock()
+
+
+def get_rate_limiter(provider: Provider, requests_per_minute: int) -> RateLimiter:
+    """Returns the rate limiter shared by every evaluation with the same limit for the provider,
+    so evaluations running in parallel stay under the limit together.
+    """
+    # Evaluations can be constructed from several threads at once
+    with _RATE_LIMITERS_LOCK:
+        rate_limiter = _RATE_LIMITERS.get((provider, requests_per_minute))
+        if rate_limiter is None:
+            rate_limiter = _RATE_LIMITERS[(provider, requests_per_minute)] = RateLimiter(requests_per_minute)
+        return rate_limiter
+
+
+def load_yaml(path: Path) -> Any:
+    """Load a YAML file with the safe loader.
+
+    Args:
+        path: The path to the YAML file.
+
+    Returns:
+        The parsed contents of the YAML file.
+    """
+    with Path.open(path) as file:
+        return yaml.load(file, Loader=SafeLoader)
+
+
+def parse_messages(messages: list[MessageT]) -> list[tuple[MessageT, BoundTemplate | None]]:
+    """Parse the Liquid template in each message's content once so it can be rendered many times.
+
+    Args:
+        messages: Messages whose string content can contain Liquid templates.
+
+    Returns:
+        Each message paired with its parsed template, to be passed to `render_messages`.
+        The template is None for static content without any Liquid markup, which never needs rendering.
+    """
+    return [
+        (message, Template(message.content) if "{{" in message.content or "{%" in message.content else None)
+        for message in messages
+    ]
+
+
+def render_messages(
+    templates: list[tuple[MessageT, BoundTemplate | None]], variables: dict[str, Any]
+) -> list[MessageT]:
+    """Render messages parsed with `parse_messages`.
+    Equivalent to not_again_ai's `compile_messages` for string content, without parsing the templates again.
+    Static messages are reused as is instead of being copied.
+
+    Args:
+        templates: The messages and their parsed templates.
+        variables: The variables to inject into the templates.
+
+    Returns:
+        Copies of the messages with their content rendered.
+    """
+    return [
+        message if template is None else message.model_copy(update={"content": template.render(**variables)})
+        for message, template in templates
+    ]
+
+
+_DOWNLOAD_LOCKS: dict[str, Lock] = {}
+_DOWNLOAD_LOCKS_LOCK = Lock()
 
 
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10), reraise=True)
 def download_file(url: str, file_name: str) -> Path:
     """Download a file from a URL with retries and return the path to the cached file.
+    A cached file whose ETag was saved is revalidated with a conditional request and only downloaded again if it changed.
 
     Args:
         url: The URL to download the file from.
@@ -41,48 +166,104 @@ def download_file(url: str, file_name: str) -> Path:
     Returns:
         The path to the cached file.
     """
-    temp_file = Path(__file__).parents[1] / "data" / "temp" / file_name
+    # Evaluations are loaded from several threads at once, and some share a dataset.
+    # Only one of them downloads it; the others wait and then use the cached file.
+    with _DOWNLOAD_LOCKS_LOCK:
+        lock = _DOWNLOAD_LOCKS.setdefault(file_name, Lock())
+    with lock:
+        return _download_file(url, file_name)
+
+
+@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10), reraise=True)
+def _download_file(url: str, file_name: str) -> Path:
+    temp_file = TEMP_DATA_PATH / file_name
+    etag_file = temp_file.with_name(f"{temp_file.name}.etag")
     if not temp_file.exists():
         temp_file.parent.mkdir(parents=True, exist_ok=True)
         logger.info(f"Downloading data from {url} to {temp_file}.")
+        with _SESSION.get(url, stream=True, timeout=_DOWNLOAD_TIMEOUT) as response:
+            response.raise_for_status()
+            _save_response(response, temp_file, etag_file)
+        return temp_file
 
-        response = requests.get(url)
-        response.raise_for_status()
-        response = response.content
-        with Path.open(temp_file, "wb") as file:
-            file.write(response)
-    else:
+    if not etag_file.exists():
         logger.info(f"File {temp_file} already exists, using cached file.")
+        return temp_file
+
+    try:
+        with _SESSION.get(
+            url, headers={"If-None-Match": etag_file.read_text()}, stream=True, timeout=_REVALIDATE_TIMEOUT
+        ) as response:
+            if response.status_code == requests.codes.not_modified:
+                logger.info(f"File {temp_file} is up to date, using cached file.")
+                return temp_file
+            response.raise_for_status()
+            logger.info(f"File {temp_file} changed, downloading it again from {url}.")
+            _save_response(response, temp_file, etag_file)
+    except requests.RequestException as e:
+        # The cached file is still usable, such as when running offline
+        logger.warning(f"Could not check {url} for changes, using cached file {temp_file}: {e}")
     return temp_file
 
 
-def download_parquet(url: str, file_name: str) -> list[dict]:
-    """Download a parquet file from a URL and return it as a list of dictionaries.
+def _save_response(response: requests.Response, temp_file: Path, etag_file: Path) -> None:
+    """Stream a response body to the cached file and save its ETag for later revalidation.
+    The body is written to a sibling file in chunks so large datasets are never held in memory whole,
+    then moved into place so an interrupted download is never mistaken for a cached file.
+    """
+    # A unique name so concurrent downloads, such as from another process, never write to the same file
+    part_file = None
+    try:
+        with tempfile.NamedTemporaryFile(
+            dir=temp_file.parent, prefix=f"{temp_file.name}.", suffix=".part", delete=False
+        ) as file:
+            part_file = Path(file.name)
+            for chunk in response.iter_content(chunk_size=1 << 20):
+                file.write(chunk)
+        part_file.replace(temp_file)
+    except BaseException:
+        if part_file is not None:
+            part_file.unlink(missing_ok=True)
+        raise
+
+    etag = response.headers.get("ETag")
+    if etag:
+        etag_file.write_text(etag)
+    else:
+        etag_file.unlink(missing_ok=True)
+
+
+def iter_parquet(url: str, file_name: str, columns: list[str] | None = None, batch_size: int = 1024) -> Iterator[dict]:
+    """Download a parquet file from a URL and lazily yield each row as a dictionary.
+    Rows are decoded one record batch at a time, so the whole file is never held in memory as Python objects.
 
     Args:
         url: The URL to download the parquet file from.
         file_name: The name of the file to cache the parquet file as.
+        columns: If set, only these columns are read, skipping the decoding of every other column.
+        batch_size: The number of rows decoded at a time.
 
-    Returns:
-        The parquet file contents as a list of dictionaries
+    Yields:
+        Each row of the parquet file as a dictionary.
     """
-
     temp_file = download_file(url, file_name)
-    with Path.open(temp_file, "rb") as file:
-        table = pq.read_table(file)
-        return table.to_pylist()
+    # Memory map the file so Arrow reads column chunks straight from the page cache instead of copying through Python
+    with pq.ParquetFile(temp_file, memory_map=True) as parquet_file:
+        for batch in parquet_file.iter_batches(batch_size=batch_size, columns=columns):
+            yield from batch.to_pylist()
 
 
-def download_jsonl(url: str, file_name: str) -> list[dict]:
-    """Download a jsonl file from a URL and return it as a list of dictionaries.
+def iter_jsonl(url: str, file_name: str) -> Iterator[dict]:
+    """Download a jsonl file from a URL and lazily yield each line as a dictionary.
 
     Args:
         url: The URL to download the jsonl file from.
         file_name: The name of the file to cache the jsonl file as.
 
-    Returns:
-        The jsonl file contents as a list of dictionaries
+    Yields:
+        Each line of the jsonl file as a dictionary.
     """
     temp_file = download_file(url, file_name)
-    with Path.open(temp_file, "r", encoding="utf-8") as file:
-        return [json.loads(line) for line in file]
+    with Path.open(temp_file, "rb") as file:
+        for line in file:
+            yield orjson.loads(line)
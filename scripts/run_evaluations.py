@@ -1,17 +1,34 @@
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import sys
 
 from loguru import logger
 from rich.progress import Progress
-import yaml
 
 from evaluate_ai.evaluation import Evaluation
 from evaluate_ai.tinydb_helpers.evaluation_data import get_executed_evaluations
+from evaluate_ai.utils import load_yaml
 
 evaluations_folder = Path(__file__).parent.parent / "data" / "evaluations"
 
 
+def load_evaluation(evaluation_path: Path) -> Evaluation | None:
+    """Load the evaluation defined in a .yaml file, logging the error and returning None if it cannot be loaded."""
+    try:
+        config = load_yaml(evaluation_path)
+        module_name = config["run_config"]["module_name"]
+        class_name = config["run_config"]["class_name"]
+        return Evaluation.load_class(module_name, class_name, config)
+    except FileNotFoundError:
+        logger.error(f"The file {evaluation_path} does not exist.")
+    except KeyError as e:
+        logger.error(f"Missing key {e} in the evaluation file at {evaluation_path}.")
+    except Exception as e:
+        logger.error(f"An unexpected error {e} occurred while loading the evaluation file at {evaluation_path}.")
+    return None
+
+
 def main():
     # By default assume all .yaml files in the evaluations folder are to be used except config.yaml
     default_files = [str(file) for file in evaluations_folder.glob("*.yaml")]
@@ -29,37 +46,37 @@ def main():
         default=True,
         help="If set, only evaluations not already in the database will be executed.",
     )
+    parser.add_argument(
+        "--max_parallel_evaluations",
+        type=int,
+        default=1,
+        help="The maximum number of evaluations executed at the same time. Each evaluation still limits its own concurrency per provider.",
+    )
     args = parser.parse_args()
     evaluation_paths = [Path(file) for file in args.files]
 
-    executed_evaluations = get_executed_evaluations() if args.only_new else set()
+    executed_evaluations = get_executed_evaluations() if args.only_new else frozenset()
 
-    # Load each evaluation using the module and class names
-    evaluation_classes = []
-    evaluations_to_run = 0
-    for evaluation_path in evaluation_paths:
-        try:
-            with Path.open(evaluation_path) as file:
-                config = yaml.safe_load(file)
-                module_name = config["run_config"]["module_name"]
-                class_name = config["run_config"]["class_name"]
-                evaluation_class: Evaluation = Evaluation.load_class(module_name, class_name, config)
-                evaluations_to_run += evaluation_class.num_instances(keys_to_skip=executed_evaluations)
-                evaluation_classes.append(evaluation_class)
-        except FileNotFoundError:
-            logger.error(f"The file {evaluation_path} does not exist.")
-            sys.exit(1)
-        except KeyError as e:
-            logger.error(f"Missing key {e} in the evaluation file at {evaluation_path}.")
-            sys.exit(1)
-        except Exception as e:
-            logger.error(f"An unexpected error {e} occurred while loading the evaluation file at {evaluation_path}.")
-            sys.exit(1)
+    # Load each evaluation using the module and class names.
+    # Loading can download a dataset, so evaluations are loaded in parallel.
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        evaluation_classes = list(executor.map(load_evaluation, evaluation_paths))
+    if None in evaluation_classes:
+        sys.exit(1)
+    evaluations_to_run = sum(
+        evaluation_class.num_instances(keys_to_skip=executed_evaluations) for evaluation_class in evaluation_classes
+    )
 
     with Progress() as progress:
         progress.add_task("Evaluations Progress", total=evaluations_to_run)
-        for evaluation_class in evaluation_classes:
-            evaluation_class.execute(progress, keys_to_skip=executed_evaluations)
+        # Evaluations are independent, so running several at once overlaps their LLM calls
+        with ThreadPoolExecutor(max_workers=max(1, args.max_parallel_evaluations)) as executor:
+            futures = [
+                executor.submit(evaluation_class.execute, progress, keys_to_skip=executed_evaluations)
+                for evaluation_class in evaluation_classes
+            ]
+            for future in futures:
+                future.result()
 
 
 if __name__ == "__main__":
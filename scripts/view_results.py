@@ -2,14 +2,14 @@
 
 import argparse
 from collections import defaultdict
+from datetime import datetime
 from enum import Enum
 
 from rich.console import Console
 from rich.padding import Padding
-from tinydb import TinyDB
 
 from evaluate_ai.evaluation import EvaluationBaseOutput
-from evaluate_ai.tinydb_helpers.db_path import TINYDB_PATH
+from evaluate_ai.tinydb_helpers.database import get_db
 
 
 class VerbosityLevel(Enum):
@@ -33,28 +33,26 @@ def main() -> None:
     )
     args = parser.parse_args()
 
-    db = TinyDB(TINYDB_PATH)
+    db = get_db()
     documents = db.all()
 
+    # Finds the latest document for each model and evaluation pair from the raw documents,
+    # so that only those are loaded into evaluation output classes.
+    latest_documents: dict[tuple[str, str], tuple[datetime, dict]] = {}
+    for evaluation_data in documents:
+        evaluation_key = f"{evaluation_data['module_name']} ({evaluation_data['evaluation_instance']['name']})"
+        model_key = f"{evaluation_data['provider']}.{evaluation_data['name_model']}"
+        execution_date = datetime.fromisoformat(evaluation_data["execution_date"])
+        latest_document = latest_documents.get((evaluation_key, model_key))
+        if latest_document is None or execution_date > latest_document[0]:
+            latest_documents[(evaluation_key, model_key)] = (execution_date, evaluation_data)
+
     latest_results = defaultdict(dict)
     # Populates latest_results with the latest evaluation output class for each model and evaluation pair.
-    for evaluation_data in documents:
-        evaluation_output_class = EvaluationBaseOutput.load_class(
+    for (evaluation_key, model_key), (_, evaluation_data) in latest_documents.items():
+        latest_results[evaluation_key][model_key] = EvaluationBaseOutput.load_class(
             evaluation_data["module_name"], evaluation_data["class_name"], evaluation_data
         )
-        evaluation_key = f"{evaluation_output_class.module_name} ({evaluation_output_class.evaluation_instance.name})"
-        model = evaluation_output_class.name_model
-        provider = evaluation_output_class.provider
-        model_key = f"{provider.value}.{model}"
-
-        if evaluation_key in latest_results and model_key in latest_results[evaluation_key]:
-            latest_result: EvaluationBaseOutput = latest_results.get(evaluation_key).get(model_key)
-            latest_result_time = latest_result.execution_date
-            evaluation_data_time = evaluation_output_class.execution_date
-            if evaluation_data_time > latest_result_time:
-                latest_results[evaluation_key][model_key] = evaluation_output_class
-        else:
-            latest_results[evaluation_key][model_key] = evaluation_output_class
 
     # Prints the latest results for each model and evaluation instance pair.
     if args.verbosity >= VerbosityLevel.DETAILED.value: